@@ -8,22 +8,42 @@ Last Modified: August 18, 2020
 """
 
 # built-in imports
+# modules only needed by some actions are imported where they are used
+# so that enable and disable do not pay for them at startup
 import argparse
+import functools
 import pathlib
 import re
 import shlex
-import shutil
 import subprocess
 import sys
-import tarfile
 import traceback
-import urllib
-
-# third-party imports
-import requests
 
 PACMD = "/usr/bin/pacmd"
 PACTL = "/usr/bin/pactl"
+LATEST_RELEASE_URL = (
+    "https://api.github.com/repos/werman/noise-suppression-for-voice/releases/latest"
+)
+
+# commands which unload the RNNoise modules
+DISABLE_COMMANDS = (
+    (PACTL, "unload-module", "module-loopback"),
+    (PACTL, "unload-module", "module-null-sink"),
+    (PACTL, "unload-module", "module-ladspa-sink"),
+    (PACTL, "unload-module", "module-remap-source"),
+)
+
+# default source and sink lines in pacmd stat output
+DEFAULT_SINKS_REGEX = re.compile(rb"^Default (source|sink) name: (.+)$", re.MULTILINE)
+
+# error messages printed by pacmd when a command fails
+PACMD_ERROR_REGEX = re.compile(
+    r"^.*(failed|does not exist|Unknown command|You need to specify).*$",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+# headers sent with every HTTP request
+HTTP_HEADERS = {"User-Agent": "rnnoise-installer"}
 
 
 def parse_arguments():
@@ -57,124 +77,151 @@ def parse_arguments():
     return parser.parse_args()
 
 
-def download(url, save_as=None, save_path=None, chunk_size=4096) -> pathlib.Path:
-    """download file to local with requests library
+def write_file_atomic(path, data):
+    """write file through a temporary file so readers never see a partial file
     Arguments:
-        url {string} -- download url
-        save_as {string/pathlib.Path} -- output file (default: {None})
-        save_path {string/pathlib.Path} -- folder to save downloaded file to (default: {None})
-    Keyword Arguments:
-        chunk_size {number} -- download stream chunk size (default: {4096})
-    Returns:
-        pathlib.Path -- full path of downloaded file
+        path {pathlib.Path} -- file to write
+        data {bytes} -- file content
     """
+    import os
+    import tempfile
 
-    # create requests stream for steaming file
-    stream = requests.get(url, stream=True, allow_redirects=True)
-
-    # determine output file path
-    # if exact output file name specified
-    if save_as:
-        output_file = pathlib.Path(save_as)
-
-    # if output directory specified
-    # or if no output is specified
-    else:
-
-        # get file name
-        file_name = None
-        if "content-disposition" in stream.headers:
-            disposition = stream.headers["content-disposition"]
-            try:
-                file_name = re.findall("filename=(.+)", disposition)[0].strip('"')
-            except IndexError:
-                pass
-
-        # if save_path is not specified, use current directory
-        if save_path is None:
-            save_path = pathlib.Path(".")
-        else:
-            save_path = pathlib.Path(save_path)
+    file_descriptor, temp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, "wb") as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
 
-        # create target folder if it doesn't exist
-        save_path.mkdir(parents=True, exist_ok=True)
 
-        # if no file name could be determined
-        # create file name from URL
-        if file_name is None:
-            output_file = save_path / stream.url.split("/")[-1]
+def get_latest_release_json(cache_path=None, ttl=3600) -> dict:
+    """get the latest release information from GitHub API
+    the response is cached on disk and revalidated with ETag once expired
+    Keyword Arguments:
+        cache_path {pathlib.Path} -- cached response file (default: {None}, latest.json in user cache dir)
+        ttl {number} -- seconds before the cache is revalidated (default: {3600})
+    Returns:
+        dict -- latest release JSON
+    """
+    import json
+    import os
+    import time
+    import urllib.error
+    import urllib.request
+
+    # keep the cache in a per-user directory so other local users
+    # cannot plant or lock a forged release response
+    if cache_path is None:
+        cache_home = os.environ.get("XDG_CACHE_HOME")
+        if cache_home:
+            cache_dir = pathlib.Path(cache_home) / "rnnoise"
         else:
-            output_file = save_path / file_name
-
-        # decode url encoding
-        output_file = pathlib.Path(urllib.parse.unquote(str(output_file)))
+            cache_dir = pathlib.Path.home() / ".cache" / "rnnoise"
+        cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        cache_path = cache_dir / "latest.json"
 
-    # get total size for progress bar if provided in headers
-    total_size = 0
-    if "content-length" in stream.headers:
-        total_size = int(stream.headers["content-length"])
+    etag_path = cache_path.with_suffix(".etag")
 
-    # print download information summary
-    print(f"Downloading: {url}")
-    print(f"Total size: {total_size}")
-    print(f"Chunk size: {chunk_size}")
-    print(f"Saving to: {output_file}")
-
-    # write content into file
-    with open(output_file, "wb") as output:
-        for chunk in stream.iter_content(chunk_size=chunk_size):
-            if chunk:
-                output.write(chunk)
-
-    # return the full path of saved file
-    return output_file
+    # return cached response if it is still fresh
+    if cache_path.is_file() and cache_path.stat().st_mtime > time.time() - ttl:
+        return json.loads(cache_path.read_text())
 
+    # revalidate the cached response if an ETag has been saved
+    headers = {**HTTP_HEADERS, "Accept": "application/vnd.github+json"}
+    if cache_path.is_file() and etag_path.is_file():
+        headers["If-None-Match"] = etag_path.read_text().strip()
 
+    try:
+        with urllib.request.urlopen(
+            urllib.request.Request(LATEST_RELEASE_URL, headers=headers)
+        ) as response:
+            response_body = response.read()
+            etag = response.headers.get("etag")
+
+    # cached response is still valid, refresh its modification time
+    except urllib.error.HTTPError as error:
+        if error.code != 304:
+            raise
+        cache_path.touch()
+        return json.loads(cache_path.read_text())
+
+    # drop the old ETag first so it is never paired with a newer body
+    # if writing is interrupted
+    etag_path.unlink(missing_ok=True)
+    write_file_atomic(cache_path, response_body)
+    if etag is not None:
+        write_file_atomic(etag_path, etag.encode())
+
+    return json.loads(response_body)
+
+
+@functools.lru_cache(maxsize=1)
 def get_default_sinks() -> tuple:
     """get PulseAudio default input and output sinks
+    the result is cached since the defaults are read before RNNoise changes them
 
     Returns:
         tuple: a tuple of the name of input sink and output sink
     """
-    pacmd_stat = subprocess.run([PACMD, "stat"], capture_output=True)
+    # newer PulseAudio and pipewire-pulse print the names directly
+    try:
+        input_sink = (
+            subprocess.run(
+                [PACTL, "get-default-source"], capture_output=True, check=True
+            )
+            .stdout.decode()
+            .strip()
+        )
+        output_sink = (
+            subprocess.run([PACTL, "get-default-sink"], capture_output=True, check=True)
+            .stdout.decode()
+            .strip()
+        )
+        return input_sink, output_sink
 
-    for line in pacmd_stat.stdout.decode().split("\n"):
-        if line.startswith("Default source name: "):
-            input_sink = line.split(": ")[1]
-        if line.startswith("Default sink name: "):
-            output_sink = line.split(": ")[1]
+    # fall back to parsing pacmd stat on older PulseAudio versions
+    except (FileNotFoundError, subprocess.CalledProcessError):
+        pass
 
-    return input_sink, output_sink
+    pacmd_stat = subprocess.run(
+        [PACMD, "stat"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True
+    )
 
+    input_sink = output_sink = None
+    for match in DEFAULT_SINKS_REGEX.finditer(pacmd_stat.stdout):
+        if match.group(1) == b"source":
+            input_sink = match.group(2).decode()
+        else:
+            output_sink = match.group(2).decode()
 
-def enable_rnnoise():
-    """load RNNoise plugin into PulseAudio
-    """
-    print("Enabling RNNoise for PulseAudio", file=sys.stderr)
-    print("Loading PulseAudio module", file=sys.stderr)
+        # stop scanning once both sinks have been found
+        if input_sink and output_sink:
+            break
 
-    ladspa_file = args.path / "bin" / "ladspa" / "librnnoise_ladspa.so"
-    input_sink, output_sink = get_default_sinks()
+    return input_sink, output_sink
 
-    # check if librnnoise_ladspa.so exists
-    if ladspa_file.is_file():
-        print(f"Found librnnoise_ladspa.so at: {ladspa_file}", file=sys.stderr)
-    else:
-        print("librnnoise_ladspa.so not found", file=sys.stderr)
-        sys.exit(1)
 
-    print(f"Found input sink: {input_sink}", file=sys.stderr)
-    print(f"Found output sink: {output_sink}", file=sys.stderr)
+def build_enable_commands(ladspa_file, input_sink) -> tuple:
+    """build the PulseAudio commands which load the RNNoise modules
 
-    commands = [
-        [
+    Arguments:
+        ladspa_file {pathlib.Path} -- path of librnnoise_ladspa.so
+        input_sink {string} -- name of the input sink to denoise
+
+    Returns:
+        tuple: pacmd commands to run in order
+    """
+    return (
+        (
             PACMD,
             "load-module",
             "module-null-sink",
             "sink_name=mic_denoised_out",
             "rate=48000",
-        ],
-        [
+        ),
+        (
             PACMD,
             "load-module",
             "module-ladspa-sink",
@@ -183,29 +230,71 @@ def enable_rnnoise():
             "label=noise_suppressor_mono",
             f"plugin={ladspa_file}",
             "control=95",
-        ],
-        [
+        ),
+        (
             PACMD,
             "load-module",
             "module-loopback",
             f"source={input_sink}",
             "sink=mic_raw_in",
             "channels=1",
-        ],
-        [
+        ),
+        (
             PACMD,
             "load-module",
             "module-remap-source",
             "source_name=denoised",
             "master=mic_denoised_out.monitor",
             "channels=1",
-        ],
-        [PACMD, "set-default-source", "denoised"],
-    ]
+        ),
+        (PACMD, "set-default-source", "denoised"),
+    )
+
+
+def enable_rnnoise():
+    """load RNNoise plugin into PulseAudio
+    """
+    print("Enabling RNNoise for PulseAudio", file=sys.stderr)
+    print("Loading PulseAudio module", file=sys.stderr)
+
+    ladspa_file = args.path / "bin" / "ladspa" / "librnnoise_ladspa.so"
+    input_sink, output_sink = get_default_sinks()
+
+    # check if librnnoise_ladspa.so exists
+    if ladspa_file.is_file():
+        print(f"Found librnnoise_ladspa.so at: {ladspa_file}", file=sys.stderr)
+    else:
+        print("librnnoise_ladspa.so not found", file=sys.stderr)
+        sys.exit(1)
+
+    print(f"Found input sink: {input_sink}", file=sys.stderr)
+    print(f"Found output sink: {output_sink}", file=sys.stderr)
+
+    commands = build_enable_commands(ladspa_file, input_sink)
 
     for command in commands:
         print(shlex.join(command), file=sys.stderr)
-        subprocess.run(command, check=True)
+
+    # send all commands to a single pacmd session through stdin
+    # pacmd joins its arguments with spaces, so the lines are built the same way
+    script = "\n".join(" ".join(command[1:]) for command in commands)
+    pacmd = subprocess.run(
+        [PACMD],
+        input=script + "\n",
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+
+    # echo pacmd output before checking the result so its reason is not lost
+    print(pacmd.stdout, end="", file=sys.stderr)
+    pacmd.check_returncode()
+
+    # pacmd exits with 0 even if a command fails, so look for error messages
+    error = PACMD_ERROR_REGEX.search(pacmd.stdout)
+    if error is not None:
+        message = error.group(0).replace(">>> ", "").strip()
+        raise RuntimeError(f"pacmd command failed: {message}")
 
 
 def disable_rnnoise():
@@ -214,14 +303,7 @@ def disable_rnnoise():
     print("Disabling RNNoise for PulseAudio", file=sys.stderr)
     print("Unloading modules from PulseAudio", file=sys.stderr)
 
-    commands = [
-        [PACTL, "unload-module", "module-loopback"],
-        [PACTL, "unload-module", "module-null-sink"],
-        [PACTL, "unload-module", "module-ladspa-sink"],
-        [PACTL, "unload-module", "module-remap-source"],
-    ]
-
-    for command in commands:
+    for command in DISABLE_COMMANDS:
         print(shlex.join(command), file=sys.stderr)
         subprocess.run(command)
 
@@ -251,17 +333,22 @@ args = parse_arguments()
 
 # download and install RNNoise file
 if args.action == "install":
-
-    if args.path.is_dir():
-        print(f"Deleting existing RNNoise files at {args.path}", file=sys.stderr)
-        shutil.rmtree(args.path)
+    import shutil
+    import tarfile
+    import urllib.request
 
     print("Downloading the latest RNNoise release file from GitHub", file=sys.stderr)
 
     download_url = None
-    latest_release_json = requests.get(
-        "https://api.github.com/repos/werman/noise-suppression-for-voice/releases/latest"
-    ).json()
+    latest_release_json = get_latest_release_json()
+    latest_version = latest_release_json["tag_name"]
+    version_file = args.path / ".rnnoise_version"
+
+    # skip reinstallation if the installed version is already the latest
+    if version_file.is_file() and version_file.read_text().strip() == latest_version:
+        print(f"RNNoise is already up to date: {latest_version}", file=sys.stderr)
+        sys.exit(0)
+
     for asset in latest_release_json["assets"]:
         if asset["name"].startswith("linux"):
             download_url = asset["browser_download_url"]
@@ -274,16 +361,34 @@ if args.action == "install":
         )
         sys.exit(1)
 
-    rnnoise_tarfile_path = download(download_url, save_as="/tmp/rnnoise.tar.gz")
+    if args.path.is_dir():
+        print(f"Deleting existing RNNoise files at {args.path}", file=sys.stderr)
+        shutil.rmtree(args.path)
 
+    # extract the archive while it is being downloaded
+    # without writing it to a temporary file first
+    print(f"Downloading: {download_url}", file=sys.stderr)
     print(f"Extracting downloaded archive to: {args.path}", file=sys.stderr)
-    rnnoise_tarfile = tarfile.open(rnnoise_tarfile_path)
-    rnnoise_tarfile.extractall(args.path)
-    rnnoise_tarfile_path.unlink()
+    with urllib.request.urlopen(
+        urllib.request.Request(download_url, headers=HTTP_HEADERS)
+    ) as stream:
+        # read the compressed stream in 1 MiB blocks instead of 10 KiB tar records
+        with tarfile.open(
+            fileobj=stream, mode="r|gz", bufsize=1024 * 1024
+        ) as rnnoise_tarfile:
+            # use the data extraction filter where supported (Python 3.12+ and backports)
+            if hasattr(tarfile, "data_filter"):
+                rnnoise_tarfile.extractall(args.path, filter="data")
+            else:
+                rnnoise_tarfile.extractall(args.path)
+
+    # record installed version for future update checks
+    version_file.write_text(latest_version)
     print(f"RNNoise has been installed to: {args.path}", file=sys.stderr)
 
 # delete installed RNNoise files from system
 elif args.action == "uninstall":
+    import shutil
 
     if args.path.is_dir():
         # disable RNNoise before removal